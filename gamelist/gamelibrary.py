@@ -1,12 +1,113 @@
+import collections
+import csv
+import datetime
+import gzip
+import itertools
+import os
+import re
 import sqlite3
+import threading
+import unicodedata
+import urllib.request
+
+# IGDB genre names, used to split the space separated genre strings of older files
+IGDB_GENRES = ['Point-and-click', 'Fighting', 'Shooter', 'Music', 'Platform', 'Puzzle', 'Racing',
+               'Real Time Strategy (RTS)', 'Role-playing (RPG)', 'Simulator', 'Sport', 'Strategy',
+               'Turn-based strategy (TBS)', 'Tactical', "Hack and slash/Beat 'em up", 'Quiz/Trivia',
+               'Pinball', 'Adventure', 'Indie', 'Arcade', 'Visual Novel', 'Card & Board Game', 'MOBA']
+
+# The genres split into words and grouped by their first word, longest first
+GENRE_WORDS = {}
+for genre in sorted(IGDB_GENRES, key=lambda name: -len(name.split())):
+    GENRE_WORDS.setdefault(genre.split()[0], []).append((genre, genre.split()))
+
+# IGDB human readable dates look like 'Mar 03, 2017', 'Mar 2017', 'Q1 2017' or '2017'
+RELEASE_DATE = re.compile(r'(?:(?:(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]*\.? +(?:(\d{1,2}),? +)?)|Q([1-4]) +)?(\d{4})')
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+def parseReleaseDate(release_date):
+    'Returns the earliest date in a release date string as a YYYYMMDD integer, unknown parts are 0'
+    dates = []
+    for month, day, quarter, year in RELEASE_DATE.findall(release_date or ''):
+        if month:
+            month = MONTHS.index(month) + 1
+        elif quarter:
+            month = int(quarter) * 3 - 2
+        else:
+            month = 0
+        dates.append(int(year) * 10000 + month * 100 + int(day or 0))
+
+    return min(dates) if dates else None
+
+# Edition suffixes like ' - Game of the Year Edition', ' (Deluxe)' or ' (Collector's Edition)', bare words
+# like 'Ultimate' are part of the title unless they are bracketed or followed by 'edition', and only these
+# names count, so 'Pokemon Gold Edition' or 'Minecraft: Wii U Edition' keep their distinguishing words
+EDITIONS = (r"game of the year|goty|deluxe|complete|definitive|special|limited|collector'?s|"
+            r"ultimate|premium|standard|enhanced|anniversary")
+EDITION = re.compile(r"(?:[\s:\-]*\b(?:{0})\s+edition|\s*[(\[]\s*(?:{0})(?:\s+edition)?\s*[)\]])\s*$".format(EDITIONS))
+
+def normalizeTitle(title):
+    'Returns the key used to find duplicate titles: case-folded, without accents, punctuation or edition suffixes'
+    title = title or ''
+    if not title.isascii():
+        title = unicodedata.normalize('NFKD', title)
+        title = ''.join(char for char in title if not unicodedata.combining(char))
+    title = title.casefold()
+
+    stripped = EDITION.sub('', title)
+    while stripped != title and stripped:
+        title = stripped
+        stripped = EDITION.sub('', title)
+
+    title = re.sub(r'[^\w\s]', '', title)
+    return ' '.join(title.split())
+
+def searchTokens(text):
+    'Splits text into lowercase words without accents, like the FTS5 unicode61 tokenizer'
+    text = text or ''
+    if not text.isascii():
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(char for char in text if not unicodedata.combining(char))
+    return re.findall(r'[^\W_]+', text.casefold())
+
+def titleTrigrams(title_key):
+    'Returns the set of trigrams in a normalized title, each word padded like pg_trgm'
+    trigrams = set()
+    for word in (title_key or '').split():
+        word = '  {} '.format(word)
+        trigrams.update(word[i:i + 3] for i in range(len(word) - 2))
+
+    return trigrams
 
 class GameLibrary:
 
-    def __init__(self, name='game.db'):
+    def __init__(self, name='game.db', fts=True, wal=False, dedupe=False, threaded=False):
         self.name = name
         self.saved = True
-        self.con = sqlite3.connect(name)
+        # Skip adding games whose platform and normalized title are already in the list
+        self.dedupe = dedupe
+        # Recent search results for getGamesByQuery() and getGamesPage(), keyed by (platform, query) and cleared on every write
+        self.searchCache = collections.OrderedDict()
+        self.searchCacheSize = 8
+        # Larger results are neither cached nor refined, getGamesPage() pages them in SQL instead
+        self.searchCacheRows = 5000
+        # Counts writes, so a search that ran on another thread while one happened isn't cached
+        self.changes = 0
+        # The search thread and the GUI thread both use the cache
+        self.searchLock = threading.Lock()
+        # Callbacks told about writes as listener(event, ids), event is 'insert', 'update', 'delete' or 'reset'
+        self.listeners = []
+        # File an in-memory library was loaded from and saves to
+        self.path = None
+        # Threaded libraries can be queried from worker threads, writes must stay on one thread
+        self.con = sqlite3.connect(name, check_same_thread=not threaded)
         self.cur = self.con.cursor()
+
+        # Reads share the main connection unless WAL mode opens a read-only one
+        self.rcon = self.con
+        if wal and name != ':memory:':
+            self.setupWal()
+
         self.cur.execute("""CREATE TABLE IF NOT EXISTS library (
                                 id              INTEGER PRIMARY KEY,
                                 platform        VARCHAR(255),
@@ -19,90 +120,867 @@ class GameLibrary:
                                 genres          VARCHAR(255)
                             )""")
 
-    def add(self, platform, title, platformid='', titleid='', cover='', coverid='', release_date='', genres=''):
-        'Adds a game to the list'
-        self.cur.execute("""INSERT INTO library (platform, title, platformid, titleid, cover, coverid, release_date, genres)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", (platform, title, platformid, titleid, cover, coverid, release_date, genres))
-        
+        # Bring files written by older versions up to date
+        self.migrate()
+
+        # Full-text index is optional, fall back to LIKE if sqlite lacks FTS5
+        self.fts = fts and self.setupFts()
+
+    def setupWal(self):
+        'Switches the file to WAL mode and opens a read-only connection for queries'
+        self.cur.execute("""PRAGMA journal_mode=WAL""")
+        if self.cur.fetchone()[0].lower() != 'wal':
+            return
+
+        uri = 'file:{}?mode=ro'.format(urllib.request.pathname2url(os.path.abspath(self.name)))
+        self.rcon = sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+        # WAL only needs to sync on checkpoints, and reads benefit from a bigger cache and mmap
+        self.cur.execute("""PRAGMA synchronous=NORMAL""")
+        for con in (self.con, self.rcon):
+            con.execute("""PRAGMA cache_size=-65536""")
+            con.execute("""PRAGMA mmap_size=268435456""")
+
+    def reader(self):
+        'Returns the connection queries should use'
+        # Unsaved changes are only visible on the main connection
+        if self.con.in_transaction:
+            return self.con
+        return self.rcon
+
+    def interrupt(self):
+        'Cancels queries running on the read connection, which then raise sqlite3.OperationalError'
+        # Without WAL this is the only connection, so the caller must not use it until the query has stopped
+        self.rcon.interrupt()
+
+    def migrate(self):
+        'Applies any schema migrations newer than the version stored in the file'
+        migrations = [self.migrateIndexes, self.migrateIds, self.migrateGenres, self.migrateReleaseDates,
+                      self.migratePlatformCounts, self.migrateTitleKeys, self.migrateTrigrams, self.migrateEditionKeys,
+                      self.migrateFtsUpdateTrigger, self.migrateEditionNames]
+
+        self.cur.execute("""PRAGMA user_version""")
+        version = self.cur.fetchone()[0]
+
+        # Each step and its version bump are committed together
+        for version, migration in enumerate(migrations[version:], version + 1):
+            self.cur.execute("""BEGIN""")
+            migration()
+            self.cur.execute("""PRAGMA user_version = {}""".format(version))
+            self.con.commit()
+
+    def migrateIndexes(self):
+        'Schema version 1: index for sorting and filtering by platform and title'
+        # Backs the ORDER BY of every listing, keyset pagination, getPlatforms() and remove()
+        self.cur.execute("""CREATE INDEX IF NOT EXISTS library_platform_title
+                            ON library (platform, title, id)""")
+
+    def migrateIds(self):
+        'Schema version 2: NULL instead of blank ids, and indexes for IGDB id lookups'
+        # INTEGER affinity already stored numeric ids as integers, anything left as text is blank or junk
+        self.cur.execute("""UPDATE library SET platformid = NULL WHERE typeof(platformid) = 'text'""")
+        self.cur.execute("""UPDATE library SET titleid = NULL WHERE typeof(titleid) = 'text'""")
+        # Cover ids are IGDB cloudinary ids, which are alphanumeric, so only blanks are cleared
+        self.cur.execute("""UPDATE library SET coverid = NULL WHERE coverid = ''""")
+
+        self.cur.execute("""CREATE INDEX IF NOT EXISTS library_titleid
+                            ON library (titleid)""")
+        self.cur.execute("""CREATE INDEX IF NOT EXISTS library_platformid
+                            ON library (platformid, title)""")
+
+    def migrateGenres(self):
+        'Schema version 3: normalized genres table and game to genre join table'
+        self.cur.execute("""CREATE TABLE IF NOT EXISTS genres (
+                                id              INTEGER PRIMARY KEY,
+                                name            VARCHAR(255) UNIQUE
+                            )""")
+        self.cur.execute("""CREATE TABLE IF NOT EXISTS game_genres (
+                                game_id         INTEGER,
+                                genre_id        INTEGER,
+                                PRIMARY KEY (genre_id, game_id)
+                            ) WITHOUT ROWID""")
+        self.cur.execute("""CREATE INDEX IF NOT EXISTS game_genres_game
+                            ON game_genres (game_id)""")
+
+        # However a game is deleted, drop its genre links with it
+        self.cur.execute("""CREATE TRIGGER IF NOT EXISTS library_genres_delete AFTER DELETE ON library BEGIN
+                                DELETE FROM game_genres WHERE game_id = old.id;
+                            END""")
+
+        # Link the games already in the file
+        cur = self.con.cursor()
+        cur.execute("""SELECT id, genres FROM library""")
+        batch = cur.fetchmany(10000)
+        while batch:
+            self.linkGenres(batch)
+            batch = cur.fetchmany(10000)
+        cur.close()
+
+    def migrateReleaseDates(self):
+        'Schema version 4: sortable earliest release date column'
+        self.cur.execute("""ALTER TABLE library ADD COLUMN first_release INTEGER""")
+
+        # Parse the release dates already in the file
+        cur = self.con.cursor()
+        cur.execute("""SELECT id, release_date FROM library
+                       WHERE release_date != ''""")
+        batch = cur.fetchmany(10000)
+        while batch:
+            self.cur.executemany("""UPDATE library SET first_release=?
+                                    WHERE id=?""", [(parseReleaseDate(date), uid) for uid, date in batch])
+            batch = cur.fetchmany(10000)
+        cur.close()
+
+        self.cur.execute("""CREATE INDEX IF NOT EXISTS library_first_release
+                            ON library (first_release, title)""")
+
+    def migratePlatformCounts(self):
+        'Schema version 5: per-platform game counts kept current by triggers'
+        self.cur.execute("""CREATE TABLE IF NOT EXISTS platform_counts (
+                                platform        VARCHAR(255) PRIMARY KEY,
+                                count           INTEGER
+                            ) WITHOUT ROWID""")
+
+        self.setupPlatformCountTriggers()
+
+        # Count the games already in the file
+        self.cur.execute("""INSERT INTO platform_counts (platform, count)
+                            SELECT platform, COUNT(*) FROM library
+                            WHERE platform IS NOT NULL
+                            GROUP BY platform""")
+
+    def migrateTitleKeys(self):
+        'Schema version 6: indexed normalized title key for finding duplicates'
+        self.cur.execute("""ALTER TABLE library ADD COLUMN title_key VARCHAR(255)""")
+
+        # Normalize the titles already in the file
+        cur = self.con.cursor()
+        cur.execute("""SELECT id, title FROM library""")
+        batch = cur.fetchmany(10000)
+        while batch:
+            self.cur.executemany("""UPDATE library SET title_key=?
+                                    WHERE id=?""", [(normalizeTitle(title), uid) for uid, title in batch])
+            batch = cur.fetchmany(10000)
+        cur.close()
+
+        self.cur.execute("""CREATE INDEX IF NOT EXISTS library_title_key
+                            ON library (title_key, platform)""")
+
+    def migrateTrigrams(self):
+        'Schema version 7: trigram index over normalized titles for fuzzy search'
+        self.cur.execute("""CREATE TABLE IF NOT EXISTS title_trigrams (
+                                trigram         VARCHAR(3),
+                                game_id         INTEGER,
+                                PRIMARY KEY (trigram, game_id)
+                            ) WITHOUT ROWID""")
+        self.cur.execute("""CREATE INDEX IF NOT EXISTS title_trigrams_game
+                            ON title_trigrams (game_id)""")
+
+        # However a game is deleted, drop its trigrams with it
+        self.cur.execute("""CREATE TRIGGER IF NOT EXISTS library_trigrams_delete AFTER DELETE ON library BEGIN
+                                DELETE FROM title_trigrams WHERE game_id = old.id;
+                            END""")
+
+        # Index the titles already in the file
+        cur = self.con.cursor()
+        cur.execute("""SELECT id, title_key FROM library""")
+        batch = cur.fetchmany(10000)
+        while batch:
+            self.indexTrigrams(batch)
+            batch = cur.fetchmany(10000)
+        cur.close()
+
+    def migrateEditionKeys(self):
+        'Schema version 8: keep bare words like Gold in title keys unless they name an edition'
+        self.rekeyTitles()
+
+    def migrateEditionNames(self):
+        'Schema version 10: only strip known edition names from title keys'
+        self.rekeyTitles()
+
+    def rekeyTitles(self):
+        'Recomputes the normalized title keys that changed and reindexes their trigrams'
+        cur = self.con.cursor()
+        cur.execute("""SELECT id, title, title_key FROM library""")
+        batch = cur.fetchmany(10000)
+        while batch:
+            # Only rekey and reindex the titles whose key changed
+            changed = [(uid, normalizeTitle(title)) for uid, title, title_key in batch if normalizeTitle(title) != title_key]
+            self.cur.executemany("""UPDATE library SET title_key=?
+                                    WHERE id=?""", [(title_key, uid) for uid, title_key in changed])
+            self.cur.executemany("""DELETE FROM title_trigrams
+                                    WHERE game_id=?""", [(uid,) for uid, title_key in changed])
+            self.indexTrigrams(changed)
+            batch = cur.fetchmany(10000)
+        cur.close()
+
+    def migrateFtsUpdateTrigger(self):
+        'Schema version 9: only reindex full-text on updates to the indexed columns, setupFts() recreates the trigger'
+        self.cur.execute("""DROP TRIGGER IF EXISTS library_fts_update""")
+
+    def setupPlatformCountTriggers(self):
+        'Creates the triggers that keep platform_counts current'
+        self.cur.execute("""CREATE TRIGGER IF NOT EXISTS platform_counts_insert AFTER INSERT ON library
+                            WHEN new.platform IS NOT NULL BEGIN
+                                INSERT INTO platform_counts (platform, count) VALUES (new.platform, 1)
+                                ON CONFLICT (platform) DO UPDATE SET count = count + 1;
+                            END""")
+        self.cur.execute("""CREATE TRIGGER IF NOT EXISTS platform_counts_delete AFTER DELETE ON library
+                            WHEN old.platform IS NOT NULL BEGIN
+                                UPDATE platform_counts SET count = count - 1 WHERE platform = old.platform;
+                                DELETE FROM platform_counts WHERE platform = old.platform AND count <= 0;
+                            END""")
+        self.cur.execute("""CREATE TRIGGER IF NOT EXISTS platform_counts_update AFTER UPDATE OF platform ON library
+                            WHEN old.platform IS NOT new.platform BEGIN
+                                UPDATE platform_counts SET count = count - 1 WHERE platform = old.platform;
+                                DELETE FROM platform_counts WHERE platform = old.platform AND count <= 0;
+                                INSERT INTO platform_counts (platform, count) SELECT new.platform, 1 WHERE new.platform IS NOT NULL
+                                ON CONFLICT (platform) DO UPDATE SET count = count + 1;
+                            END""")
+
+    def setupFts(self):
+        'Creates the full-text index and its sync triggers, returns False if FTS5 is unavailable'
+        self.cur.execute("""SELECT name FROM sqlite_master
+                            WHERE type='table' AND name='library_fts'""")
+        exists = self.cur.fetchone() is not None
+
+        try:
+            self.cur.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS library_fts USING fts5 (
+                                    platformid, title, titleid, cover, coverid, release_date, genres,
+                                    content='library', content_rowid='id'
+                                )""")
+        except sqlite3.OperationalError:
+            return False
+
+        self.setupFtsTriggers()
+
+        # Index rows that were added before the index existed
+        if not exists:
+            self.cur.execute("""INSERT INTO library_fts (library_fts) VALUES ('rebuild')""")
+            self.con.commit()
+
+        return True
+
+    def setupFtsTriggers(self):
+        'Creates the triggers that keep the full-text index in sync with the library table'
+        self.cur.execute("""CREATE TRIGGER IF NOT EXISTS library_fts_insert AFTER INSERT ON library BEGIN
+                                INSERT INTO library_fts (rowid, platformid, title, titleid, cover, coverid, release_date, genres)
+                                VALUES (new.id, new.platformid, new.title, new.titleid, new.cover, new.coverid, new.release_date, new.genres);
+                            END""")
+        self.cur.execute("""CREATE TRIGGER IF NOT EXISTS library_fts_delete AFTER DELETE ON library BEGIN
+                                INSERT INTO library_fts (library_fts, rowid, platformid, title, titleid, cover, coverid, release_date, genres)
+                                VALUES ('delete', old.id, old.platformid, old.title, old.titleid, old.cover, old.coverid, old.release_date, old.genres);
+                            END""")
+        self.cur.execute("""CREATE TRIGGER IF NOT EXISTS library_fts_update
+                            AFTER UPDATE OF platformid, title, titleid, cover, coverid, release_date, genres ON library BEGIN
+                                INSERT INTO library_fts (library_fts, rowid, platformid, title, titleid, cover, coverid, release_date, genres)
+                                VALUES ('delete', old.id, old.platformid, old.title, old.titleid, old.cover, old.coverid, old.release_date, old.genres);
+                                INSERT INTO library_fts (rowid, platformid, title, titleid, cover, coverid, release_date, genres)
+                                VALUES (new.id, new.platformid, new.title, new.titleid, new.cover, new.coverid, new.release_date, new.genres);
+                            END""")
+
+    def add(self, platform, title, platformid=None, titleid=None, cover='', coverid=None, release_date='', genres=''):
+        'Adds a game to the list and returns its id, or None if dedupe is on and it is already there'
+        title_key = normalizeTitle(title)
+
+        if self.dedupe:
+            self.cur.execute("""SELECT id FROM library
+                                WHERE title_key=? AND platform=?""", (title_key, platform))
+            if self.cur.fetchone() is not None:
+                return None
+
+        # Blank ids are stored as NULL and genres may be a list of names
+        genres = self.joinGenres(genres)
+        self.cur.execute("""INSERT INTO library (platform, title, platformid, titleid, cover, coverid, release_date, genres, first_release, title_key)
+                            VALUES (?, ?, NULLIF(?, ''), NULLIF(?, ''), ?, NULLIF(?, ''), ?, ?, ?, ?)""",
+                         (platform, title, platformid, titleid, cover, coverid, release_date, genres, parseReleaseDate(release_date), title_key))
+        uid = self.cur.lastrowid
+        self.linkGenres([(uid, genres)])
+        self.indexTrigrams([(uid, title_key)])
+
+        self.__clearSearchCache()
         self.saved = False
+        self.notify('insert', [uid])
+        return uid
+
+    def add_many(self, games, chunksize=10000, progress=None):
+        'Adds many games to the list, each game is a tuple in the same order as add()'
+        games = iter(games)
+        count = 0
+
+        # Indexing and counting each chunk in one statement is much faster than the per-row insert triggers
+        self.__begin()
+        self.cur.execute("""DROP TRIGGER IF EXISTS platform_counts_insert""")
+        if self.fts:
+            self.cur.execute("""DROP TRIGGER IF EXISTS library_fts_insert""")
+
+        try:
+            # Insert in chunks so a large iterable is never held in memory at once
+            while True:
+                chunk = [self.__row(game) for game in itertools.islice(games, chunksize)]
+                if not chunk:
+                    break
+
+                if self.dedupe:
+                    chunk = self.__dedupe(chunk)
+                    if not chunk:
+                        continue
+
+                self.cur.execute("""SELECT IFNULL(MAX(id), 0) FROM library""")
+                lastid = self.cur.fetchone()[0]
+
+                self.cur.executemany("""INSERT INTO library (platform, title, platformid, titleid, cover, coverid, release_date, genres, first_release, title_key)
+                                        VALUES (?, ?, NULLIF(?, ''), NULLIF(?, ''), ?, NULLIF(?, ''), ?, ?, ?, ?)""", chunk)
+
+                self.cur.execute("""SELECT id, genres, title_key FROM library
+                                    WHERE id > ?""", (lastid,))
+                added = self.cur.fetchall()
+                self.linkGenres([(uid, genres) for uid, genres, title_key in added])
+                self.indexTrigrams([(uid, title_key) for uid, genres, title_key in added])
+
+                self.cur.execute("""INSERT INTO platform_counts (platform, count)
+                                    SELECT platform, COUNT(*) FROM library
+                                    WHERE id > ? AND platform IS NOT NULL
+                                    GROUP BY platform
+                                    ON CONFLICT (platform) DO UPDATE SET count = count + excluded.count""", (lastid,))
+
+                if self.fts:
+                    self.cur.execute("""INSERT INTO library_fts (rowid, platformid, title, titleid, cover, coverid, release_date, genres)
+                                        SELECT id, platformid, title, titleid, cover, coverid, release_date, genres FROM library
+                                        WHERE id > ?""", (lastid,))
+
+                count += len(chunk)
+                self.__clearSearchCache()
+                self.saved = False
+                self.notify('insert', [uid for uid, genres, title_key in added])
+
+                if progress is not None:
+                    progress(count)
+
+        finally:
+            self.setupPlatformCountTriggers()
+            if self.fts:
+                self.setupFtsTriggers()
+
+        return count
+
+    def addListener(self, listener):
+        'Calls listener(event, ids) after every change to the list'
+        self.listeners.append(listener)
+
+    def removeListener(self, listener):
+        'Stops calling a listener added with addListener()'
+        self.listeners.remove(listener)
+
+    def notify(self, event, ids):
+        'Tells every listener which games an event touched'
+        for listener in self.listeners:
+            listener(event, ids)
+
+    def __begin(self):
+        'Opens a transaction if there is none, so schema changes roll back with unsaved data'
+        if not self.con.in_transaction:
+            self.cur.execute("""BEGIN""")
+
+    def __row(self, game):
+        'Pads a game tuple with the same defaults as add() and appends its parsed release date and title key'
+        game = tuple(game)[:8]
+        game = game + ('',) * (8 - len(game))
+        return game[:7] + (self.joinGenres(game[7]), parseReleaseDate(game[6]), normalizeTitle(game[1]))
+
+    def __dedupe(self, rows):
+        'Drops rows whose platform and title key are already in the list or earlier in rows'
+        keys = list(set(row[9] for row in rows))
+        seen = set()
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            self.cur.execute("""SELECT platform, title_key FROM library
+                                WHERE title_key IN ({})""".format(', '.join('?' * len(batch))), batch)
+            seen.update(self.cur.fetchall())
+
+        unique = []
+        for row in rows:
+            if (row[0], row[9]) not in seen:
+                seen.add((row[0], row[9]))
+                unique.append(row)
+
+        return unique
+
+    def joinGenres(self, genres):
+        'Turns a list of genre names into the string stored in the library table'
+        if genres is None or isinstance(genres, str):
+            return genres
+        return ', '.join(genres)
+
+    def splitGenres(self, genres):
+        'Splits a stored genre string into genre names'
+        if not genres:
+            return []
+
+        if ',' in genres:
+            return [name.strip() for name in genres.split(',') if name.strip()]
+
+        # Older files separated names with spaces and left a trailing one
+        if not genres.endswith(' '):
+            return [genres.strip()]
+
+        words = genres.split()
+        names = []
+        i = 0
+        while i < len(words):
+            # Prefer the longest known IGDB genre starting at this word
+            for name, nameWords in GENRE_WORDS.get(words[i], []):
+                if words[i:i + len(nameWords)] == nameWords:
+                    names.append(name)
+                    i += len(nameWords)
+                    break
+            else:
+                names.append(words[i])
+                i += 1
+
+        return names
+
+    def indexTrigrams(self, games):
+        'Adds games to the title trigram index given (id, title key) pairs'
+        self.cur.executemany("""INSERT OR IGNORE INTO title_trigrams (trigram, game_id)
+                                VALUES (?, ?)""",
+                             [(trigram, uid) for uid, title_key in games for trigram in titleTrigrams(title_key)])
+
+    def linkGenres(self, games):
+        'Links games to their genres given (id, genre string) pairs'
+        pairs = [(uid, name) for uid, genres in games for name in self.splitGenres(genres)]
+        names = list(set(name for uid, name in pairs))
+        if not names:
+            return
+
+        self.cur.executemany("""INSERT OR IGNORE INTO genres (name)
+                                VALUES (?)""", [(name,) for name in names])
+
+        # Look up the ids of this batch's genres once rather than per link
+        genreIds = {}
+        for i in range(0, len(names), 500):
+            batch = names[i:i + 500]
+            self.cur.execute("""SELECT name, id FROM genres
+                                WHERE name IN ({})""".format(', '.join('?' * len(batch))), batch)
+            genreIds.update(self.cur.fetchall())
+
+        self.cur.executemany("""INSERT OR IGNORE INTO game_genres (game_id, genre_id)
+                                VALUES (?, ?)""", [(uid, genreIds[name]) for uid, name in pairs])
 
     def remove(self, platform, title):
         'Removes a game from the list'
+        self.cur.execute("""SELECT id FROM library
+                            WHERE platform=? AND
+                                  title=?""", (platform, title))
+        ids = [item[0] for item in self.cur.fetchall()]
+
         self.cur.execute("""DELETE FROM library
                             WHERE platform=? AND
                                   title=?""", (platform, title))
+        self.__clearSearchCache()
         self.saved = False
+        self.notify('delete', ids)
 
-    def update(self, uid, platform=None, platformid=None, title=None, titleid=None, cover=None, coverid=None, release_date=None, genres=None):
-        'Updates a game in the list'
-        
-        game = self.getGamesById(uid)
-
-        # If any of the values are None, set them to the current value
-        if platform == None:        platform = game[1]
-        if platformid == None:      platformid = game[2]
-        if title == None:           title = game[3]
-        if titleid == None:         titleid = game[4]
-        if cover == None:           cover = game[5]
-        if coverid == None:         coverid = game[6]
-        if release_date == None:    release_date = game[7]
-        if genres == None:          genres = game[8]
-        
-        self.cur.execute("""UPDATE library
-                            SET platform=?, platformid=?, title=?, titleid=?, cover=?, coverid=?, release_date=?, genres=?
-                            WHERE id=?""", (platform, platformid, title, titleid, cover, coverid, release_date, genres, uid))
+    def remove_by_id(self, uid):
+        'Removes a game from the list by its id'
+        self.remove_many([uid])
+
+    def remove_many(self, ids):
+        'Removes many games from the list by their ids'
+        ids = list(ids)
 
+        # The per-row FTS delete trigger is slow, so large batches unindex in bulk instead
+        bulk = self.fts and len(ids) >= 100
+        if bulk:
+            self.__begin()
+            self.cur.execute("""DROP TRIGGER IF EXISTS library_fts_delete""")
+            self.__ftsIndex(ids, delete=True)
+
+        try:
+            self.cur.executemany("""DELETE FROM library
+                                    WHERE id=?""", [(uid,) for uid in ids])
+
+        finally:
+            if bulk:
+                self.setupFtsTriggers()
+
+        self.__clearSearchCache()
         self.saved = False
-        
+        self.notify('delete', ids)
+
+    def update(self, uid, platform=None, platformid=None, title=None, titleid=None, cover=None, coverid=None, release_date=None, genres=None):
+        'Updates a game in the list, only the fields that are not None are written'
+        self.update_many([(uid, {'platform': platform, 'platformid': platformid, 'title': title, 'titleid': titleid,
+                                 'cover': cover, 'coverid': coverid, 'release_date': release_date, 'genres': genres})])
+
+    def update_many(self, updates):
+        'Updates many games given (id, changes) pairs, where changes maps field names to new values'
+        columns = ['platform', 'platformid', 'title', 'titleid', 'cover', 'coverid', 'release_date', 'genres']
+
+        # Games changing the same fields share one statement
+        groups = {}
+        for uid, changes in updates:
+            changes = {field: value for field, value in changes.items() if value is not None}
+            for field in changes:
+                if field not in columns:
+                    raise ValueError('Unknown field: {}'.format(field))
+            if changes:
+                fields = tuple(field for field in columns if field in changes)
+                groups.setdefault(fields, []).append((uid, changes))
+
+        for fields, games in groups.items():
+            assignments = []
+            for field in fields:
+                if field in ('platformid', 'titleid', 'coverid'):
+                    assignments.append("{}=NULLIF(?, '')".format(field))
+                else:
+                    assignments.append('{}=?'.format(field))
+            if 'release_date' in fields:
+                assignments.append('first_release=?')
+            if 'title' in fields:
+                assignments.append('title_key=?')
+
+            rows = []
+            for uid, changes in games:
+                if 'genres' in changes:
+                    changes['genres'] = self.joinGenres(changes['genres'])
+                row = [changes[field] for field in fields]
+                if 'release_date' in fields:
+                    row.append(parseReleaseDate(changes['release_date']))
+                if 'title' in fields:
+                    row.append(normalizeTitle(changes['title']))
+                rows.append(row + [uid])
+
+            # The per-row FTS update trigger is slow, so large groups reindex in bulk instead,
+            # platform isn't indexed so changing only that never touches the index
+            bulk = self.fts and len(rows) >= 100 and fields != ('platform',)
+            if bulk:
+                ids = [uid for uid, changes in games]
+                self.__begin()
+                self.cur.execute("""DROP TRIGGER IF EXISTS library_fts_update""")
+                self.__ftsIndex(ids, delete=True)
+
+            try:
+                self.cur.executemany("""UPDATE library
+                                        SET {}
+                                        WHERE id=?""".format(', '.join(assignments)), rows)
+                if bulk:
+                    self.__ftsIndex(ids)
+
+            finally:
+                if bulk:
+                    self.setupFtsTriggers()
+
+            # Reindex titles and relink genres for the games that changed them
+            if 'title' in fields:
+                self.cur.executemany("""DELETE FROM title_trigrams
+                                        WHERE game_id=?""", [(uid,) for uid, changes in games])
+                self.indexTrigrams([(uid, normalizeTitle(changes['title'])) for uid, changes in games])
+
+            if 'genres' in fields:
+                self.cur.executemany("""DELETE FROM game_genres
+                                        WHERE game_id=?""", [(uid,) for uid, changes in games])
+                self.linkGenres([(uid, changes['genres']) for uid, changes in games])
+
+            self.__clearSearchCache()
+            self.saved = False
+            self.notify('update', [uid for uid, changes in games])
+
+    def __ftsIndex(self, ids, delete=False):
+        'Adds games to the full-text index, or removes them using their current values'
+        for i in range(0, len(ids), 500):
+            batch = ids[i:i + 500]
+            if delete:
+                self.cur.execute("""INSERT INTO library_fts (library_fts, rowid, platformid, title, titleid, cover, coverid, release_date, genres)
+                                    SELECT 'delete', id, platformid, title, titleid, cover, coverid, release_date, genres FROM library
+                                    WHERE id IN ({})""".format(', '.join('?' * len(batch))), batch)
+            else:
+                self.cur.execute("""INSERT INTO library_fts (rowid, platformid, title, titleid, cover, coverid, release_date, genres)
+                                    SELECT id, platformid, title, titleid, cover, coverid, release_date, genres FROM library
+                                    WHERE id IN ({})""".format(', '.join('?' * len(batch))), batch)
+
     def getGames(self):
         'Retrieves all games'
-        self.cur.execute("""SELECT * FROM library
-                            ORDER BY platform ASC, title ASC""")
+        cur = self.reader().cursor()
+        cur.execute("""SELECT * FROM library
+                       ORDER BY platform ASC, title ASC""")
         
-        return self.cur.fetchall()
+        return cur.fetchall()
+
+    def iterGames(self, batchsize=1000):
+        'Yields all games, fetching them in batches'
+        # Use a separate cursor so other queries don't interrupt the iteration
+        cur = self.reader().cursor()
+        cur.execute("""SELECT * FROM library
+                       ORDER BY platform ASC, title ASC""")
+
+        batch = cur.fetchmany(batchsize)
+        while batch:
+            yield from batch
+            batch = cur.fetchmany(batchsize)
+
+        cur.close()
 
     def getGamesById(self, uid):
         'Retrieves a game by its id'
-        self.cur.execute("""SELECT * FROM library
-                            WHERE id=?""", (uid,))
+        cur = self.reader().cursor()
+        cur.execute("""SELECT * FROM library
+                       WHERE id=?""", (uid,))
+
+        return cur.fetchone()
+
+    def getGamesByIds(self, ids, query='', platform=''):
+        'Retrieves the games out of ids that match a query and platform the same way as getGamesPage()'
+        cur = self.reader().cursor()
+        ids = list(ids)
+        games = []
+
+        where = []
+        params = []
+        if platform != '':
+            where.append('platform = ?')
+            params.append(platform)
+        if query != '':
+            clause, args = self.__queryFilter(query)
+            where.append(clause)
+            params += args
+
+        for i in range(0, len(ids), 500):
+            batch = ids[i:i + 500]
+            sql = 'SELECT * FROM library WHERE ' + ' AND '.join(where + ['id IN ({})'.format(', '.join('?' * len(batch)))])
+            cur.execute(sql, params + batch)
+            games += cur.fetchall()
+
+        return games
+
+    def getGamesByTitleId(self, titleid):
+        'Retrieves games by their IGDB title id'
+        cur = self.reader().cursor()
+        cur.execute("""SELECT * FROM library
+                       WHERE titleid=?
+                       ORDER BY platform ASC, title ASC""", (titleid,))
 
-        return self.cur.fetchone()
+        return cur.fetchall()
+
+    def getGamesByPlatformId(self, platformid):
+        'Retrieves games by their IGDB platform id'
+        cur = self.reader().cursor()
+        cur.execute("""SELECT * FROM library
+                       WHERE platformid=?
+                       ORDER BY title ASC""", (platformid,))
+
+        return cur.fetchall()
 
     def getGamesByQuery(self, query='', platform=''):
         'Retrieves games with any field that matchs a query'
+        changes = self.changes
+        games = self.__cachedQuery(query, platform)
+        if games is None:
+            games = self.__queryGames(query, platform)
+            self.__cacheQuery(query, platform, games, changes)
+
+        return list(games)
+
+    def __cachedQuery(self, query, platform):
+        'Returns the cached list of games matching a query, refining a cached shorter query if possible, or None'
+        key = (platform, query)
+        with self.searchLock:
+            games = self.searchCache.get(key)
+            if games is not None:
+                self.searchCache.move_to_end(key)
+                return games
+            changes = self.changes
+            cached = list(self.searchCache.items())
+
+        # A query that extends a cached one can only match a subset of its games, as long as both go
+        # through FTS, LIKE's wildcards and ASCII-only case folding aren't worth copying for the fallback
+        base = None
+        if self.fts and searchTokens(query):
+            for (cachedPlatform, cachedQuery), games in cached:
+                extends = cachedPlatform == platform and query.startswith(cachedQuery)
+                if extends and searchTokens(cachedQuery):
+                    if base is None or len(cachedQuery) > len(base[0]):
+                        base = (cachedQuery, games)
+
+        if base is None:
+            return None
+
+        games = [game for game in base[1] if self.__matchesQuery(game, query)]
+        self.__cacheQuery(query, platform, games, changes)
+        return games
+
+    def __cacheQuery(self, query, platform, games, changes):
+        'Caches a small enough query result, unless the list changed since changes was read'
+        with self.searchLock:
+            if changes != self.changes or len(games) > self.searchCacheRows:
+                return
+
+            self.searchCache[(platform, query)] = games
+            if len(self.searchCache) > self.searchCacheSize:
+                self.searchCache.popitem(last=False)
+
+    def __clearSearchCache(self):
+        'Empties the search cache after a write, and stops searches already running from caching'
+        with self.searchLock:
+            self.changes += 1
+            self.searchCache.clear()
+
+    def __matchesQuery(self, game, query):
+        'Checks a game against a query in memory, the same way getGamesByQuery() does with FTS'
+        fields = [str(value) for value in game[2:9] if value is not None]
+
+        words = searchTokens(' '.join(fields))
+        return all(any(word.startswith(token) for word in words) for token in searchTokens(query))
+
+    def __queryGames(self, query, platform):
+        'Runs getGamesByQuery() against the database'
+        cur = self.reader().cursor()
+
+        # Each word in the query is matched as a token prefix
+        tokens = searchTokens(query)
+        if self.fts and tokens:
+            match = ' '.join('"{}"*'.format(token) for token in tokens)
+            return self.getGamesByMatch(match, platform)
 
         query = '%{}%'.format(query)
 
         # If platform is not blank, include it in the query
         if platform != '':
-            self.cur.execute("""SELECT * FROM library
-                                WHERE platform = ? AND
-                                    ( platformid LIKE ? OR
-                                      title LIKE ? OR
-                                      titleid LIKE ? OR
-                                      cover LIKE ? OR
-                                      coverid LIKE ? OR
-                                      release_date LIKE ? OR
-                                      genres LIKE ? )
-                                ORDER BY platform ASC, title ASC""",
-                             (platform, query, query, query, query, query, query, query))
+            cur.execute("""SELECT * FROM library
+                           WHERE platform = ? AND
+                               ( platformid LIKE ? OR
+                                 title LIKE ? OR
+                                 titleid LIKE ? OR
+                                 cover LIKE ? OR
+                                 coverid LIKE ? OR
+                                 release_date LIKE ? OR
+                                 genres LIKE ? )
+                           ORDER BY platform ASC, title ASC, id ASC""",
+                        (platform, query, query, query, query, query, query, query))
 
         else:
-            self.cur.execute("""SELECT * FROM library
-                                WHERE platformid LIKE ? OR
-                                      title LIKE ? OR
-                                      titleid LIKE ? OR
-                                      cover LIKE ? OR
-                                      coverid LIKE ? OR
-                                      release_date LIKE ? OR
-                                      genres LIKE ?
-                                ORDER BY platform ASC, title ASC""",
-                             (query, query, query, query, query, query, query))
-
-        return self.cur.fetchall()
+            cur.execute("""SELECT * FROM library
+                           WHERE platformid LIKE ? OR
+                                 title LIKE ? OR
+                                 titleid LIKE ? OR
+                                 cover LIKE ? OR
+                                 coverid LIKE ? OR
+                                 release_date LIKE ? OR
+                                 genres LIKE ?
+                           ORDER BY platform ASC, title ASC, id ASC""",
+                        (query, query, query, query, query, query, query))
+
+        return cur.fetchall()
+
+    def getGamesByMatch(self, match, platform=''):
+        'Retrieves games using an FTS5 match expression'
+        cur = self.reader().cursor()
+
+        # If platform is not blank, include it in the query
+        if platform != '':
+            cur.execute("""SELECT * FROM library
+                           WHERE platform = ? AND
+                                 id IN (SELECT rowid FROM library_fts WHERE library_fts MATCH ?)
+                           ORDER BY platform ASC, title ASC, id ASC""", (platform, match))
+
+        else:
+            cur.execute("""SELECT * FROM library
+                           WHERE id IN (SELECT rowid FROM library_fts WHERE library_fts MATCH ?)
+                           ORDER BY platform ASC, title ASC, id ASC""", (match,))
+
+        return cur.fetchall()
+
+    def getGamesPage(self, after=None, limit=100, query='', platform=''):
+        'Retrieves a page of games after a (platform, title, id) cursor, returns the page and the next cursor'
+        games = None
+        if query != '':
+            changes = self.changes
+            cached = self.__cachedQuery(query, platform)
+
+            # The first page of a search fetches up to the cache size, if that is the whole result it is cached
+            if cached is None and after is None:
+                games = self.__queryPage(None, self.searchCacheRows + 1, query, platform)
+                if len(games) <= self.searchCacheRows:
+                    self.__cacheQuery(query, platform, games, changes)
+                    cached = games
+                games = games[:limit]
+
+            # Small searches page through the cached result, so typing more of the query can refine it
+            if cached is not None:
+                start = 0 if after is None else self.__seek(cached, after)
+                games = cached[start:start + limit]
+
+        # Everything else is a keyset query
+        if games is None:
+            games = self.__queryPage(after, limit, query, platform)
+
+        # A short page means there is nothing left
+        if len(games) < limit:
+            return games, None
+
+        last = games[-1]
+        return games, (last[1], last[3], last[0])
+
+    def __seek(self, games, after):
+        'Returns the index of the first game in a (platform, title, id) sorted list past a cursor'
+        def sortKey(values):
+            return tuple((value is not None, value) for value in values)
+
+        after = sortKey(after)
+        low, high = 0, len(games)
+        while low < high:
+            middle = (low + high) // 2
+            if sortKey((games[middle][1], games[middle][3], games[middle][0])) <= after:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def __queryPage(self, after, limit, query, platform):
+        'Runs getGamesPage() against the database'
+        cur = self.reader().cursor()
+        where = []
+        params = []
+
+        if platform != '':
+            where.append('platform = ?')
+            params.append(platform)
+
+        if query != '':
+            clause, args = self.__queryFilter(query)
+            where.append(clause)
+            params += args
+
+        # Seek past the last row of the previous page
+        if after is not None:
+            where.append('(platform, title, id) > (?, ?, ?)')
+            params += list(after)
+
+        sql = 'SELECT * FROM library'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY platform ASC, title ASC, id ASC LIMIT ?'
+        params.append(limit)
+
+        cur.execute(sql, params)
+        return cur.fetchall()
+
+    def __queryFilter(self, query):
+        'Builds a WHERE clause and parameters matching a query the same way as getGamesByQuery()'
+        tokens = searchTokens(query)
+        if self.fts and tokens:
+            match = ' '.join('"{}"*'.format(token) for token in tokens)
+            return 'id IN (SELECT rowid FROM library_fts WHERE library_fts MATCH ?)', [match]
+
+        query = '%{}%'.format(query)
+        columns = ['platformid', 'title', 'titleid', 'cover', 'coverid', 'release_date', 'genres']
+        clause = '(' + ' OR '.join('{} LIKE ?'.format(column) for column in columns) + ')'
+        return clause, [query] * len(columns)
 
     def getGamesBySearch(self, query='', platform='', platformid='', title='', titleid='', cover='', coverid='', release_date='', genres=''):
         'Retrieves games that match search terms'
+        cur = self.reader().cursor()
 
         # Platform should match exactly, so don't wrap in wildcards
         platformid =    '%{}%'.format(platformid)
@@ -115,81 +993,304 @@ class GameLibrary:
 
         # If platform is not blank, include it in the query
         if platform != '':
-            self.cur.execute("""SELECT * FROM library
-                                WHERE platform = ? AND
-                                      platformid LIKE ? AND
-                                      title LIKE ? AND
-                                      titleid LIKE ? AND
-                                      cover LIKE ? AND
-                                      coverid LIKE ? AND
-                                      release_date LIKE ? AND
-                                      genres LIKE ?
-                                ORDER BY platform ASC, title ASC""",
-                             (platform, platformid, title, titleid, cover, coverid, release_date, genres))
+            cur.execute("""SELECT * FROM library
+                           WHERE platform = ? AND
+                                 IFNULL(platformid, '') LIKE ? AND
+                                 title LIKE ? AND
+                                 IFNULL(titleid, '') LIKE ? AND
+                                 cover LIKE ? AND
+                                 IFNULL(coverid, '') LIKE ? AND
+                                 release_date LIKE ? AND
+                                 genres LIKE ?
+                           ORDER BY platform ASC, title ASC""",
+                        (platform, platformid, title, titleid, cover, coverid, release_date, genres))
 
         else:
-            self.cur.execute("""SELECT * FROM library
-                                WHERE platformid LIKE ? AND
-                                      title LIKE ? AND
-                                      titleid LIKE ? AND
-                                      cover LIKE ? AND
-                                      coverid LIKE ? AND
-                                      release_date LIKE ? AND
-                                      genres LIKE ?
-                                ORDER BY platform ASC, title ASC""",
-                             (platformid, title, titleid, cover, coverid, release_date, genres))
-
-        return self.cur.fetchall()        
+            cur.execute("""SELECT * FROM library
+                           WHERE IFNULL(platformid, '') LIKE ? AND
+                                 title LIKE ? AND
+                                 IFNULL(titleid, '') LIKE ? AND
+                                 cover LIKE ? AND
+                                 IFNULL(coverid, '') LIKE ? AND
+                                 release_date LIKE ? AND
+                                 genres LIKE ?
+                           ORDER BY platform ASC, title ASC""",
+                        (platformid, title, titleid, cover, coverid, release_date, genres))
+
+        return cur.fetchall()        
 
     def getGamesByPlatform(self, platform):
         'Retrieves games by platform'
+        cur = self.reader().cursor()
         
-        self.cur.execute("""SELECT * FROM library
-                            WHERE platform=?
-                            ORDER BY platform ASC, title ASC""", (platform,))
+        cur.execute("""SELECT * FROM library
+                       WHERE platform=?
+                       ORDER BY platform ASC, title ASC""", (platform,))
 
-        return self.cur.fetchall()
+        return cur.fetchall()
+
+    def getGamesByReleaseRange(self, start, end, platform=''):
+        'Retrieves games first released between two years or datetime.dates, inclusive'
+        cur = self.reader().cursor()
+        start = self.__releaseBound(start, 0)
+        end = self.__releaseBound(end, 9999)
+
+        # If platform is not blank, include it in the query
+        if platform != '':
+            cur.execute("""SELECT * FROM library
+                           WHERE first_release BETWEEN ? AND ? AND
+                                 platform=?
+                           ORDER BY first_release ASC, title ASC""", (start, end, platform))
+
+        else:
+            cur.execute("""SELECT * FROM library
+                           WHERE first_release BETWEEN ? AND ?
+                           ORDER BY first_release ASC, title ASC""", (start, end))
+
+        return cur.fetchall()
+
+    def __releaseBound(self, bound, monthday):
+        'Converts a year or datetime.date to a YYYYMMDD bound'
+        if isinstance(bound, datetime.date):
+            return bound.year * 10000 + bound.month * 100 + bound.day
+        return int(bound) * 10000 + monthday
+
+    def getGamesByGenre(self, genre, platform=''):
+        'Retrieves games by genre'
+        cur = self.reader().cursor()
+
+        # If platform is not blank, include it in the query
+        if platform != '':
+            cur.execute("""SELECT library.* FROM genres
+                           JOIN game_genres ON game_genres.genre_id = genres.id
+                           JOIN library ON library.id = game_genres.game_id
+                           WHERE genres.name=? AND library.platform=?
+                           ORDER BY library.platform ASC, library.title ASC""", (genre, platform))
+
+        else:
+            cur.execute("""SELECT library.* FROM genres
+                           JOIN game_genres ON game_genres.genre_id = genres.id
+                           JOIN library ON library.id = game_genres.game_id
+                           WHERE genres.name=?
+                           ORDER BY library.platform ASC, library.title ASC""", (genre,))
+
+        return cur.fetchall()
+
+    def getGenres(self):
+        'Retrieves all genres with the number of games in each'
+        cur = self.reader().cursor()
+        cur.execute("""SELECT genres.name, COUNT(*) FROM genres
+                       JOIN game_genres ON game_genres.genre_id = genres.id
+                       GROUP BY genres.id
+                       ORDER BY genres.name ASC""")
+
+        return cur.fetchall()
+
+    def fuzzySearch(self, query, limit=20, platform=''):
+        'Retrieves the games whose titles best match a query, tolerating typos and word order'
+        cur = self.reader().cursor()
+        trigrams = titleTrigrams(normalizeTitle(query))
+        if not trigrams:
+            return []
+
+        # Trigrams shared by thousands of titles don't help find candidates, so prefer the rarer ones
+        counts = {}
+        for trigram in trigrams:
+            cur.execute("""SELECT COUNT(*) FROM (SELECT 1 FROM title_trigrams
+                                                 WHERE trigram=?
+                                                 LIMIT 2000)""", (trigram,))
+            counts[trigram] = cur.fetchone()[0]
+
+        selected = sorted(trigrams, key=counts.get)
+        rare = [trigram for trigram in selected if counts[trigram] < 2000]
+        selected = rare if len(rare) >= 3 else selected[:3]
+
+        # Candidates share the most selected trigrams, filtering by platform before the cap so other platforms can't fill it
+        if platform != '':
+            cur.execute("""SELECT game_id FROM title_trigrams
+                           JOIN library ON library.id = game_id AND library.platform = ?
+                           WHERE trigram IN ({})
+                           GROUP BY game_id
+                           ORDER BY COUNT(*) DESC
+                           LIMIT ?""".format(', '.join('?' * len(selected))), [platform] + selected + [limit * 20])
+        else:
+            cur.execute("""SELECT game_id FROM title_trigrams
+                           WHERE trigram IN ({})
+                           GROUP BY game_id
+                           ORDER BY COUNT(*) DESC
+                           LIMIT ?""".format(', '.join('?' * len(selected))), selected + [limit * 20])
+        ids = [item[0] for item in cur.fetchall()]
+        if not ids:
+            return []
+
+        cur.execute("""SELECT * FROM library
+                       WHERE id IN ({})""".format(', '.join('?' * len(ids))), ids)
+        games = cur.fetchall()
+
+        # Rank by trigram similarity, the share of all trigrams the query and title have in common
+        def similarity(game):
+            title = titleTrigrams(game[10])
+            return len(trigrams & title) / len(trigrams | title)
+
+        games.sort(key=lambda game: (-similarity(game), game[3]))
+        return games[:limit]
+
+    def findDuplicates(self):
+        'Retrieves the ids of games that share a platform and normalized title, one list per group'
+        cur = self.reader().cursor()
+        cur.execute("""SELECT GROUP_CONCAT(id) FROM library
+                       WHERE title_key IS NOT NULL
+                       GROUP BY title_key, platform
+                       HAVING COUNT(*) > 1""")
+
+        return [[int(uid) for uid in ids.split(',')] for ids, in cur]
+
+    def getFacets(self, query='', platform=''):
+        'Retrieves game counts by platform, genre and release year for the games matching a query'
+        cur = self.reader().cursor()
+        where = []
+        params = []
+
+        if platform != '':
+            where.append('platform = ?')
+            params.append(platform)
+
+        if query != '':
+            clause, args = self.__queryFilter(query)
+            where.append(clause)
+            params += args
+
+        sql = 'SELECT id, platform, first_release FROM library'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+
+        # The matches are found once and grouped three ways
+        cur.execute("""WITH matches AS ({})
+                       SELECT 'platform', platform, COUNT(*) FROM matches
+                       GROUP BY platform
+                       UNION ALL
+                       SELECT 'genre', genres.name, COUNT(*) FROM matches
+                       JOIN game_genres ON game_genres.game_id = matches.id
+                       JOIN genres ON genres.id = game_genres.genre_id
+                       GROUP BY genres.id
+                       UNION ALL
+                       SELECT 'year', first_release / 10000, COUNT(*) FROM matches
+                       WHERE first_release IS NOT NULL
+                       GROUP BY first_release / 10000""".format(sql), params)
+
+        facets = {'platform': [], 'genre': [], 'year': []}
+        for facet, value, count in cur:
+            facets[facet].append((value, count))
+
+        for values in facets.values():
+            values.sort(key=lambda item: (item[0] is None, item[0]))
+
+        return facets
 
     def getPlatforms(self):
         'Retrieves all platforms'
-        self.cur.execute("""SELECT DISTINCT platform FROM library
-                            ORDER BY platform ASC""")
+        cur = self.reader().cursor()
+        cur.execute("""SELECT platform FROM platform_counts
+                       ORDER BY platform ASC""")
+
+        return [item[0] for item in cur]
+
+    def getPlatformCounts(self):
+        'Retrieves all platforms with the number of games on each'
+        cur = self.reader().cursor()
+        cur.execute("""SELECT platform, count FROM platform_counts
+                       ORDER BY platform ASC""")
+
+        return cur.fetchall()
+
+    def load(self, filepath, pages=1024, progress=None):
+        'Replaces the list with a copy of a file, progress is called with pages copied and total pages'
+        # Anything unsaved is being replaced anyway
+        self.con.rollback()
+
+        source = sqlite3.connect(filepath)
+        try:
+            source.backup(self.con, pages=pages, progress=self.__backupProgress(progress))
+        finally:
+            source.close()
 
-        return [item[0] for item in self.cur]
+        self.path = filepath
+        self.__clearSearchCache()
+        self.saved = True
+
+        # The copy may come from an older version
+        self.migrate()
+        self.fts = self.fts and self.setupFts()
+        self.notify('reset', [])
 
-    def save(self):
-        'Saves changes made to the list'
+    def save(self, filepath=None, pages=1024, progress=None):
+        'Saves changes made to the list, in-memory lists are then copied to filepath or the file they were loaded from'
         self.con.commit()
+
+        if filepath is not None:
+            self.path = filepath
+
+        # Copy page by page so a large save can report progress
+        if self.path is not None and (self.name == ':memory:' or filepath is not None):
+            target = sqlite3.connect(self.path)
+            try:
+                self.con.backup(target, pages=pages, progress=self.__backupProgress(progress))
+            finally:
+                target.close()
+
         self.saved = True
 
+    def __backupProgress(self, progress):
+        'Adapts a progress(done, total) callback to the one sqlite3 backup() expects'
+        if progress is None:
+            return None
+        return lambda status, remaining, total: progress(total - remaining, total)
+
     def close(self):
         'Closes list'
+        # A cursor left holding an executemany() statement would keep the file locked
+        try:
+            self.cur.close()
+        except sqlite3.ProgrammingError:
+            # Already closed
+            pass
+        # Close the writer last so it can checkpoint and remove the WAL file
+        self.rcon.close()
         self.con.close()
 
-    def import_(self, filepath):
-        'Imports from a .csv file'
-        if not filepath.endswith('.csv'):
+    def import_(self, filepath, progress=None):
+        'Imports from a .csv or .csv.gz file, progress is called with the number of rows imported so far'
+        if not filepath.endswith(('.csv', '.csv.gz')):
             filepath += '.csv'
-        
-        infile = open(filepath)
 
-        for line in infile:
-            ln = line.rstrip().split(',')
-            self.add(ln[0], ln[2], ln[1], ln[3], ln[4], ln[5], ln[6], ln[7])
+        if filepath.endswith('.gz'):
+            infile = gzip.open(filepath, 'rt', newline='')
+        else:
+            infile = open(filepath, newline='')
 
-        infile.close()
+        with infile:
+            # Columns are in export order: platform, platformid, title, titleid, ...
+            rows = ((ln[0], ln[2], ln[1], ln[3], ln[4], ln[5], ln[6], ln[7])
+                    for ln in csv.reader(infile) if len(ln) >= 8)
 
-    def export(self, filepath):
-        'Exports to a .csv file'
-        if not filepath.endswith('.csv'):
-            filepath += '.csv'
-        
-        outfile = open(filepath, 'w')
-        
-        for record in self.getGames():
-            outfile.write('{},{},{},{},{},{},{},{},\n'.format(record[1], record[2], record[3], record[4], record[5], record[6], record[7], record[8]))
+            return self.add_many(rows, progress=progress)
+
+    def export(self, filepath, compress=False):
+        'Exports to a .csv file, or a gzipped .csv.gz file if compress is set'
+        if compress:
+            if not filepath.endswith('.csv.gz'):
+                filepath += '.gz' if filepath.endswith('.csv') else '.csv.gz'
+            outfile = gzip.open(filepath, 'wt', newline='')
+        else:
+            if not filepath.endswith('.csv'):
+                filepath += '.csv'
+            outfile = open(filepath, 'w', newline='', buffering=1 << 16)
+
+        with outfile:
+            writer = csv.writer(outfile, lineterminator='\n')
 
-        outfile.close()
+            # Keep the trailing empty column the format has always had
+            writer.writerows(record[1:9] + ('',) for record in self.iterGames())
 
     def __del__(self):
         self.close()
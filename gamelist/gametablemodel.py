@@ -0,0 +1,131 @@
+import bisect
+
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex, QVariant
+
+
+class GameTableModel(QAbstractTableModel):
+    'Table model that pages games out of a GameLibrary as the view scrolls'
+
+    # Header and the library column shown under it
+    columns = [('Platform', 1), ('Title', 3), ('Release Date', 7), ('Genres', 8)]
+
+    def __init__(self, gamelib, pagesize=200, parent=None):
+        super(GameTableModel, self).__init__(parent)
+        self.gamelib = gamelib
+        self.pagesize = pagesize
+        self.query = ''
+        self.platform = ''
+        self.games = []
+        self.cursor = None
+
+    def setLibrary(self, gamelib):
+        'Points the model at another library, call setQuery() afterwards to reload'
+        self.gamelib = gamelib
+
+    def setQuery(self, query='', platform='', page=None):
+        'Resets the model to the first page of games matching query and platform, page is a (games, cursor) already fetched'
+        if page is None:
+            page = self.gamelib.getGamesPage(limit=self.pagesize, query=query, platform=platform)
+
+        self.beginResetModel()
+        self.query = query
+        self.platform = platform
+        self.games, self.cursor = page
+        self.endResetModel()
+
+    def gameId(self, row):
+        'Returns the id of the game shown in a row'
+        return self.games[row][0]
+
+    def insertGames(self, ids):
+        'Shows newly added games that match the query and fall inside the loaded rows'
+        ids = list(ids)
+
+        # Reloading is cheaper than placing a large batch one row at a time
+        if len(ids) > self.pagesize:
+            self.setQuery(self.query, self.platform)
+            return
+
+        keys = [self.sortKey(game) for game in self.games]
+        for game in self.gamelib.getGamesByIds(ids, self.query, self.platform):
+            key = self.sortKey(game)
+
+            # Rows past the last page are picked up by fetchMore()
+            if self.cursor is not None and keys and key > keys[-1]:
+                continue
+
+            row = bisect.bisect_left(keys, key)
+            self.beginInsertRows(QModelIndex(), row, row)
+            self.games.insert(row, game)
+            keys.insert(row, key)
+            self.endInsertRows()
+
+    def removeGames(self, ids):
+        'Drops removed games from the loaded rows'
+        ids = set(ids)
+
+        # Remove from the bottom so earlier row numbers stay valid
+        for row in reversed(range(len(self.games))):
+            if self.games[row][0] in ids:
+                self.beginRemoveRows(QModelIndex(), row, row)
+                del self.games[row]
+                self.endRemoveRows()
+
+    def updateGames(self, ids):
+        'Moves changed games to where they now sort, or drops them if they no longer match'
+        ids = list(ids)
+        self.removeGames(ids)
+        self.insertGames(ids)
+
+    def sortKey(self, game):
+        'Orders games the same way as GameLibrary.getGamesPage(), NULLs first'
+        return tuple((value is not None, value) for value in (game[1], game[3], game[0]))
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.games)
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.columns)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return QVariant()
+
+        game = self.games[index.row()]
+
+        if role == Qt.DisplayRole:
+            value = game[self.columns[index.column()][1]]
+            return '' if value is None else str(value)
+
+        if role == Qt.UserRole:
+            return game[0]
+
+        return QVariant()
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.columns[section][0]
+        return QVariant()
+
+    def canFetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return False
+        return self.cursor is not None
+
+    def fetchMore(self, parent=QModelIndex()):
+        'Appends the next page of games after the last row loaded'
+        if parent.isValid() or self.cursor is None:
+            return
+
+        games, self.cursor = self.gamelib.getGamesPage(after=self.cursor, limit=self.pagesize,
+                                                       query=self.query, platform=self.platform)
+        if not games:
+            return
+
+        self.beginInsertRows(QModelIndex(), len(self.games), len(self.games) + len(games) - 1)
+        self.games += games
+        self.endInsertRows()
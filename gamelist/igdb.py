@@ -1,31 +1,305 @@
 
-import urllib.request
+import asyncio
+import concurrent.futures
+import gzip
+import http.client
+import random
+import sqlite3
+import ssl
+import threading
+import time
+import urllib.error
+import urllib.parse
 import json
 
 
+class TokenBucket:
+    'Rate limiter handing out rate tokens a second and saving up at most burst of them'
+
+    def __init__(self, rate=4, burst=4):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def delay(self):
+        'Takes a token and returns how many seconds to wait before using it'
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # Going below zero reserves a future token, so waiting callers queue up in order
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
+def backoff(attempt, headers=None, base=0.5, cap=30):
+    'Returns a random wait before retry attempt, doubling each time, or what the server asked for in Retry-After'
+    wait = random.uniform(0, min(cap, base * 2 ** attempt))
+
+    retryafter = headers.get('Retry-After') if headers is not None else None
+    if retryafter is not None and retryafter.strip().isdigit():
+        wait = max(wait, min(cap, int(retryafter)))
+
+    return wait
+
+
+def retryable(error):
+    'Returns whether an HTTP error is worth retrying, being rate limited or a server error'
+    return error.code == 429 or error.code >= 500
+
+
 class igdb:
 
-    def __init__(self, apikey):
+    def __init__(self, apikey, poolsize=4, timeout=30, cache=None, cachesize=10000, rate=4, burst=4, retries=5,
+                 maxwait=30):
         self.url = 'https://api-2445582011268.apicast.io'
         self.apikey = apikey
         self.platformlist = ''
         self.headers = {
             'user-key': self.apikey,
-            'Accept': 'application/json'
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip'
+        }
+
+        # Idle keep-alive connections, shared between threads
+        self.poolsize = poolsize
+        self.timeout = timeout
+        self.pool = []
+        self.poollock = threading.Lock()
+
+        # Requests are spaced out to the API quota, rate limited and server errors are retried,
+        # waiting at most maxwait seconds between tries, so interactive callers can keep both small
+        self.limiter = TokenBucket(rate, burst)
+        self.retries = retries
+        self.maxwait = maxwait
+
+        # Seconds a cached response is fresh for, by endpoint, and how long after that it is served while refetching
+        self.ttls = {
+            'games': 24 * 3600,
+            'platforms': 24 * 3600,
+            'companies': 7 * 24 * 3600,
+            'count': 3600,
+            'meta': 7 * 24 * 3600
         }
- 
+        self.stale = 7 * 24 * 3600
+
+        # Responses are cached in an sqlite file if one is given
+        self.cachecon = None
+        self.cachesize = cachesize
+        self.cachelock = threading.Lock()
+        self.revalidating = set()
+        if cache is not None:
+            self.setupCache(cache)
+
+    def setupCache(self, filename):
+        'Opens the response cache'
+        self.cachecon = sqlite3.connect(filename, check_same_thread=False)
+
+        # Lookups bump their last use, which should not wait on a disk sync
+        self.cachecon.execute("""PRAGMA journal_mode=WAL""")
+        self.cachecon.execute("""PRAGMA synchronous=NORMAL""")
+        self.cachecon.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                    url             TEXT PRIMARY KEY,
+                                    body            TEXT,
+                                    fetched         REAL,
+                                    used            REAL
+                                ) WITHOUT ROWID""")
+        self.cachecon.execute("""CREATE INDEX IF NOT EXISTS responses_used ON responses (used)""")
+        self.cachecon.commit()
+
+    def clearCache(self, endpoint=None):
+        'Drops cached responses, only those for one endpoint if given'
+        if self.cachecon is None:
+            return
+
+        with self.cachelock:
+            if endpoint is None:
+                self.cachecon.execute("""DELETE FROM responses""")
+            else:
+                prefix = self.__cacheKey(self.url + '/{}/'.format(endpoint))
+                self.cachecon.execute("""DELETE FROM responses
+                                          WHERE url=? OR substr(url, 1, ?) IN (?, ?)""",
+                                      (prefix, len(prefix) + 1, prefix + '/', prefix + '?'))
+            self.cachecon.commit()
+
     def __request(self, url):
         url = url.replace(' ', '%20')
-        print(url + '\n')
+        if self.cachecon is None:
+            return json.loads(self.__fetch(url))
+
+        key = self.__cacheKey(url)
+        ttl = self.__ttl(key)
+
+        cached = self.__cacheGet(key)
+        if cached is not None:
+            body, age = cached
+            if age < ttl:
+                return json.loads(body)
 
-        req = urllib.request.Request(url, headers=self.headers)
-        response = urllib.request.urlopen(req)
-            
-        json_string = response.read().decode()
-        parsed_json = json.loads(json_string)
+            # Answer with the old copy while a newer one downloads
+            if age < ttl + self.stale:
+                self.__revalidate(url, key)
+                return json.loads(body)
+
+        body = self.__fetch(url)
+        parsed_json = json.loads(body)
+        self.__cachePut(key, body)
 
         return parsed_json
 
+    def __cacheKey(self, url):
+        'Normalizes a url so the same request is cached once whatever its parameter order'
+        parts = urllib.parse.urlsplit(url)
+        path = urllib.parse.quote(urllib.parse.unquote(parts.path)).rstrip('/')
+        query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True)))
+
+        return urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, query, ''))
+
+    def __ttl(self, key):
+        'Returns how long a response stays fresh, by its endpoint'
+        segments = urllib.parse.urlsplit(key).path.strip('/').split('/')
+        if len(segments) > 1 and segments[1] in ('count', 'meta'):
+            return self.ttls[segments[1]]
+        return self.ttls.get(segments[0], 3600)
+
+    def __cacheGet(self, key):
+        'Returns a cached response body and its age in seconds, or None'
+        now = time.time()
+        with self.cachelock:
+            row = self.cachecon.execute("""SELECT body, fetched FROM responses
+                                           WHERE url=?""", (key,)).fetchone()
+            if row is None:
+                return None
+
+            self.cachecon.execute("""UPDATE responses
+                                      SET used=?
+                                      WHERE url=?""", (now, key))
+            self.cachecon.commit()
+
+        return row[0], now - row[1]
+
+    def __cachePut(self, key, body):
+        'Stores a response body, evicting the least recently used ones past cachesize'
+        now = time.time()
+        with self.cachelock:
+            self.cachecon.execute("""INSERT OR REPLACE INTO responses (url, body, fetched, used)
+                                      VALUES (?, ?, ?, ?)""", (key, body, now, now))
+            self.cachecon.execute("""DELETE FROM responses
+                                      WHERE used <= (SELECT used FROM responses
+                                                     ORDER BY used DESC
+                                                     LIMIT 1 OFFSET ?)""", (self.cachesize,))
+            self.cachecon.commit()
+
+    def __revalidate(self, url, key):
+        'Refetches a stale response in the background, once at a time per url'
+        with self.cachelock:
+            if key in self.revalidating:
+                return
+            self.revalidating.add(key)
+
+        threading.Thread(target=self.__refresh, args=(url, key), daemon=True).start()
+
+    def __refresh(self, url, key):
+        'Downloads a newer copy of a cached response'
+        try:
+            body = self.__fetch(url)
+            json.loads(body)
+            self.__cachePut(key, body)
+        except Exception:
+            # keep serving the stale copy until it expires
+            pass
+        finally:
+            with self.cachelock:
+                self.revalidating.discard(key)
+
+    def __fetch(self, url):
+        'Downloads a url and returns the response text, waiting for the rate limiter and retrying with backoff'
+        for attempt in range(self.retries + 1):
+            time.sleep(self.limiter.delay())
+            try:
+                return self.__download(url)
+            except urllib.error.HTTPError as e:
+                if not retryable(e) or attempt == self.retries:
+                    raise
+                time.sleep(backoff(attempt, e.headers, cap=self.maxwait))
+
+    def __download(self, url):
+        'Downloads a url and returns the response text'
+        print(url + '\n')
+
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+
+        # A pooled connection may have been closed by the server while idle, so retry once on a new one
+        con, reused = self.__connection(parts.scheme, parts.netloc)
+        try:
+            response = self.__send(con, path)
+        except (http.client.HTTPException, ConnectionError):
+            if not reused:
+                raise
+            con, reused = self.__connection(parts.scheme, parts.netloc, fresh=True)
+            response = self.__send(con, path)
+
+        body = response.read()
+        if response.will_close:
+            con.close()
+        else:
+            self.__release(parts.scheme, parts.netloc, con)
+
+        if response.status >= 400:
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+
+        if response.getheader('Content-Encoding', '').lower() == 'gzip':
+            body = gzip.decompress(body)
+
+        return body.decode()
+
+    def __send(self, con, path):
+        'Sends a GET request on a connection and returns the response'
+        try:
+            con.request('GET', path, headers=self.headers)
+            return con.getresponse()
+        except Exception:
+            con.close()
+            raise
+
+    def __connection(self, scheme, host, fresh=False):
+        'Returns an idle connection to host, or a new one, and whether it was reused'
+        if not fresh:
+            with self.poollock:
+                for i in reversed(range(len(self.pool))):
+                    if self.pool[i][0] == (scheme, host):
+                        return self.pool.pop(i)[1], True
+
+        if scheme == 'http':
+            return http.client.HTTPConnection(host, timeout=self.timeout), False
+        return http.client.HTTPSConnection(host, timeout=self.timeout), False
+
+    def __release(self, scheme, host, con):
+        'Puts a connection back in the pool, closing it if the pool is full'
+        with self.poollock:
+            if len(self.pool) < self.poolsize:
+                self.pool.append(((scheme, host), con))
+                return
+        con.close()
+
+    def close(self):
+        'Closes all pooled connections and the response cache'
+        with self.poollock:
+            pool, self.pool = self.pool, []
+        for key, con in pool:
+            con.close()
+
+        if self.cachecon is not None:
+            with self.cachelock:
+                self.cachecon.close()
+                self.cachecon = None
+
     def games(self, args=''):
         'Gets the index of game.'
         return self.__request(self.url + '/games/{}'.format(args))
@@ -75,15 +349,27 @@ class igdb:
         return self.__request(self.url + '/companies/meta/{}'.format(args))
 
     # ----- helper functions -----
-    def get_platforms(self, args=''):
-        'Gets all platforms'
-        offset = 0
+    def get_platforms(self, args='', workers=None):
+        'Gets all platforms, downloading the pages the count says there are in parallel'
+        if workers is None:
+            workers = self.poolsize
+
+        # Pages come back from map() in the order they were asked for
+        count = self.platforms_count()['count']
+        offsets = range(0, count, 50)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            pages = list(executor.map(lambda offset: self.platforms('?offset={}&limit=50{}'.format(offset, args)), offsets))
+
         platforms = []
-        temp = self.platforms('?offset={}&limit=50{}'.format(offset, args))
-        while len(temp) > 0:
-            platforms += temp
+        for page in pages:
+            platforms += page
+
+        # Keep going one page at a time in case platforms were added since the count
+        offset = len(offsets) * 50
+        while not pages or len(pages[-1]) == 50:
+            pages.append(self.platforms('?offset={}&limit=50{}'.format(offset, args)))
+            platforms += pages[-1]
             offset += 50
-            temp = self.platforms('?offset={}&limit=50{}'.format(offset, args))
 
         return platforms
 
@@ -105,3 +391,231 @@ class igdb:
         'Loads json from a file'
         with open(filename) as json_data:
             return json.load(json_data)
+
+
+class AsyncIGDB:
+    'The igdb endpoints as coroutines, many requests share a few keep-alive connections from one thread'
+
+    def __init__(self, apikey, concurrency=100, timeout=30, rate=4, burst=4, retries=5, maxwait=30):
+        self.url = 'https://api-2445582011268.apicast.io'
+        self.apikey = apikey
+        self.headers = {
+            'user-key': self.apikey,
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip'
+        }
+
+        # At most concurrency requests are in flight, each holding one connection
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.pool = []
+        self.sslcontext = ssl.create_default_context()
+
+        # Requests are spaced out to the API quota, rate limited and server errors are retried,
+        # waiting at most maxwait seconds between tries, so interactive callers can keep both small
+        self.limiter = TokenBucket(rate, burst)
+        self.retries = retries
+        self.maxwait = maxwait
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def __request(self, url):
+        url = url.replace(' ', '%20')
+
+        # Wait for the rate limiter outside the semaphore so waiting requests do not hold a slot
+        for attempt in range(self.retries + 1):
+            await asyncio.sleep(self.limiter.delay())
+            try:
+                return await self.__download(url)
+            except urllib.error.HTTPError as e:
+                if not retryable(e) or attempt == self.retries:
+                    raise
+                await asyncio.sleep(backoff(attempt, e.headers, cap=self.maxwait))
+
+    async def __download(self, url):
+        'Downloads a url and returns the parsed json'
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+
+        async with self.semaphore:
+            # A pooled connection may have been closed by the server while idle, so retry once on a new one
+            reader, writer, reused = await self.__connection(parts.scheme, parts.netloc)
+            try:
+                status, reason, headers, body, keepalive = await self.__send(reader, writer, parts.netloc, path)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                if not reused:
+                    raise
+                reader, writer, reused = await self.__connection(parts.scheme, parts.netloc, fresh=True)
+                status, reason, headers, body, keepalive = await self.__send(reader, writer, parts.netloc, path)
+
+            if keepalive:
+                self.pool.append(((parts.scheme, parts.netloc), reader, writer))
+            else:
+                writer.close()
+
+        if status >= 400:
+            raise urllib.error.HTTPError(url, status, reason, headers, None)
+
+        if headers.get('Content-Encoding', '').lower() == 'gzip':
+            body = gzip.decompress(body)
+
+        return json.loads(body.decode())
+
+    async def __connection(self, scheme, host, fresh=False):
+        'Returns an idle connection to host, or a new one, and whether it was reused'
+        if not fresh:
+            for i in reversed(range(len(self.pool))):
+                if self.pool[i][0] == (scheme, host):
+                    key, reader, writer = self.pool.pop(i)
+                    return reader, writer, True
+
+        hostname, _, port = host.partition(':')
+        if scheme == 'http':
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(hostname, int(port or 80)), self.timeout)
+        else:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(hostname, int(port or 443), ssl=self.sslcontext),
+                                                    self.timeout)
+        return reader, writer, False
+
+    async def __send(self, reader, writer, host, path):
+        'Sends a GET request and reads the response, closing the connection if anything goes wrong'
+        try:
+            return await asyncio.wait_for(self.__exchange(reader, writer, host, path), self.timeout)
+        except BaseException:
+            writer.close()
+            raise
+
+    async def __exchange(self, reader, writer, host, path):
+        'Writes an HTTP/1.1 request and returns the status, reason, headers, body and whether to keep the connection'
+        lines = ['GET {} HTTP/1.1'.format(path), 'Host: {}'.format(host), 'Connection: keep-alive']
+        lines += ['{}: {}'.format(name, value) for name, value in self.headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+        statusline = await reader.readline()
+        if not statusline:
+            raise ConnectionResetError('Connection closed by server')
+        version, status, reason = (statusline.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+
+        headers = http.client.HTTPMessage()
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip()] = value.strip()
+
+        keepalive = version == 'HTTP/1.1' and headers.get('Connection', '').lower() != 'close'
+
+        if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    # skip any trailers
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b''.join(chunks)
+        elif headers.get('Content-Length') is not None:
+            body = await reader.readexactly(int(headers['Content-Length']))
+        else:
+            # the body runs until the server closes the connection
+            body = await reader.read()
+            keepalive = False
+
+        return int(status), reason, headers, body, keepalive
+
+    async def close(self):
+        'Closes all pooled connections'
+        pool, self.pool = self.pool, []
+        for key, reader, writer in pool:
+            writer.close()
+        for key, reader, writer in pool:
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, ssl.SSLError):
+                pass
+
+    async def games(self, args=''):
+        'Gets the index of game.'
+        return await self.__request(self.url + '/games/{}'.format(args))
+
+    async def games_id(self, gameid, args=''):
+        'Gets specific ids of game.'
+        return await self.__request(self.url + '/games/{}/{}'.format(gameid, args))
+
+    async def games_count(self, args=''):
+        'Gets the count of games.'
+        return await self.__request(self.url + '/games/count/{}'.format(args))
+
+    async def games_meta(self, args=''):
+        'Gets the fields of game.'
+        return await self.__request(self.url + '/games/meta/{}'.format(args))
+
+    async def platforms(self, args=''):
+        'Gets the index of platform.'
+        return await self.__request(self.url + '/platforms/{}'.format(args))
+
+    async def platforms_id(self, platformid, args=''):
+        'Gets specific ids of platform.'
+        return await self.__request(self.url + '/platforms/{}/{}'.format(platformid, args))
+
+    async def platforms_count(self, args=''):
+        'Gets the count of platforms.'
+        return await self.__request(self.url + '/platforms/count/{}'.format(args))
+
+    async def platforms_meta(self, args=''):
+        'Gets the fields of platform.'
+        return await self.__request(self.url + '/platforms/meta/{}'.format(args))
+
+    async def companies(self, args=''):
+        'Gets the index of company.'
+        return await self.__request(self.url + '/companies/{}'.format(args))
+
+    async def companies_id(self, companyid, args=''):
+        'Gets specific ids of company.'
+        return await self.__request(self.url + '/companies/{}/{}'.format(companyid, args))
+
+    async def companies_count(self, args=''):
+        'Gets the count of companies.'
+        return await self.__request(self.url + '/companies/count/{}'.format(args))
+
+    async def companies_meta(self, args=''):
+        'Gets the fields of companies.'
+        return await self.__request(self.url + '/companies/meta/{}'.format(args))
+
+    # ----- helper functions -----
+    async def get_platforms(self, args=''):
+        'Gets all platforms, requesting every page the count says there are at once'
+        count = (await self.platforms_count())['count']
+        offsets = range(0, count, 50)
+        pages = list(await asyncio.gather(*[self.platforms('?offset={}&limit=50{}'.format(offset, args)) for offset in offsets]))
+
+        platforms = []
+        for page in pages:
+            platforms += page
+
+        # Keep going one page at a time in case platforms were added since the count
+        offset = len(offsets) * 50
+        while not pages or len(pages[-1]) == 50:
+            pages.append(await self.platforms('?offset={}&limit=50{}'.format(offset, args)))
+            platforms += pages[-1]
+            offset += 50
+
+        return platforms
+
+    async def get_games(self, platformid):
+        'Gets all games for a platform'
+        games = await self.platforms_id(platformid, '?fields=name,games&expand=games')
+        games = games[0]['games']
+
+        all_games = [item['name'] for item in games]
+
+        return all_games
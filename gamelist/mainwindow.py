@@ -1,10 +1,15 @@
+import concurrent.futures
 import os
+import sqlite3
+import urllib.error
 import gamelist.gamelibrary
 import gamelist.igdb
 import gamelist.platforms
 
-from PyQt5.QtCore import QStringListModel
-from PyQt5.QtWidgets import QMainWindow, QCompleter, QTableWidgetItem, QDialog, QFileDialog, QMessageBox
+from PyQt5.QtCore import QStringListModel, QTimer, pyqtSignal
+from PyQt5.QtWidgets import QApplication, QMainWindow, QCompleter, QDialog, QFileDialog, QMessageBox
+
+from gamelist.gametablemodel import GameTableModel
 
 from gamelist.mainwindow_ui import Ui_MainWindow
 from gamelist.aboutdialog_ui import Ui_AboutDialog
@@ -12,6 +17,9 @@ from gamelist.aboutdialog_ui import Ui_AboutDialog
 
 class GameListGUI(QMainWindow):
 
+    # Emitted from the search thread with the search number, its query and platform, and the first page
+    searchFinished = pyqtSignal(int, str, str, object)
+
     def __init__(self):
         super(GameListGUI, self).__init__()
         self.ui = Ui_MainWindow()
@@ -20,7 +28,7 @@ class GameListGUI(QMainWindow):
         # Widgets
         self.platformComboBox = self.ui.platformComboBox
         self.searchLineEdit = self.ui.searchLineEdit
-        self.table = self.ui.tableWidget
+        self.table = self.ui.tableView
         self.platformLineEdit = self.ui.platformLineEdit
         self.titleLineEdit = self.ui.titleLineEdit
         self.addButton = self.ui.addButton
@@ -28,9 +36,21 @@ class GameListGUI(QMainWindow):
 
         # Class members
         self.filename = 'untitled.db'
-        self.igdb = gamelist.igdb.igdb('API-KEY-GOES-HERE')
-        self.gamelib = gamelist.gamelibrary.GameLibrary(self.filename)
+        # Lookups block the window, so give up after a couple of short retries
+        self.igdb = gamelist.igdb.igdb('API-KEY-GOES-HERE', cache='igdbcache.dat', retries=2, maxwait=2)
+        self.gamelib = gamelist.gamelibrary.GameLibrary(':memory:', threaded=True)
         self.platforms = gamelist.platforms.Platforms('platforms.dat')
+        self.model = GameTableModel(self.gamelib, parent=self)
+        self.table.setModel(self.model)
+        self.gamelib.addListener(self.libraryChanged)
+
+        # Searches wait for a pause in typing and run one at a time off the GUI thread
+        self.searchTimer = QTimer(self)
+        self.searchTimer.setSingleShot(True)
+        self.searchTimer.setInterval(250)
+        self.searchPool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.searchFuture = None
+        self.searchCount = 0
 
         self.setupUi()
         self.refreshUi()
@@ -47,7 +67,9 @@ class GameListGUI(QMainWindow):
 
         # Other signals and slots
         self.ui.platformComboBox.activated.connect(self.displayTableWrapper)
-        self.ui.searchLineEdit.textChanged.connect(self.displayTableWrapper)
+        self.ui.searchLineEdit.textChanged.connect(self.queueSearch)
+        self.searchTimer.timeout.connect(self.startSearch)
+        self.searchFinished.connect(self.showSearch)
         self.ui.addButton.clicked.connect(self.addRecord)
         self.ui.titleLineEdit.returnPressed.connect(self.addRecord)
         self.ui.platformLineEdit.editingFinished.connect(self.setupTitleCompleter)
@@ -66,6 +88,7 @@ class GameListGUI(QMainWindow):
         'Updates the platform database'
         try:
             self.statusbar.showMessage('Updating... downloading platforms.')
+            self.igdb.clearCache('platforms')
             plats = self.igdb.get_platforms('&fields=name')
 
             self.statusbar.showMessage('Updating... updating local database.')
@@ -119,6 +142,22 @@ class GameListGUI(QMainWindow):
         self.displayComboBox()
         self.displayTableWrapper()
 
+    def libraryChanged(self, event, ids):
+        'Applies a change to the list to the table and combobox without rebuilding them'
+        if event == 'reset':
+            self.refreshUi()
+            return
+
+        if event == 'insert':
+            self.model.insertGames(ids)
+        elif event == 'update':
+            self.model.updateGames(ids)
+        elif event == 'delete':
+            self.model.removeGames(ids)
+
+        self.displayTitle()
+        self.updateComboBox()
+
     def displayTitle(self):
         'Displays the file name in the window title'
 
@@ -150,69 +189,122 @@ class GameListGUI(QMainWindow):
             if self.ui.platformComboBox.itemText(i) == selectedPlatform:
                 self.ui.platformComboBox.setCurrentIndex(i)
 
+    def updateComboBox(self):
+        'Adds and removes only the platforms that changed in the combobox'
+        platforms = self.gamelib.getPlatforms()
+        shown = [self.ui.platformComboBox.itemText(i) for i in range(1, self.ui.platformComboBox.count())]
+
+        if platforms == shown:
+            return
+
+        # Drop platforms with no games left, going back to all platforms if the selected one went
+        selectedPlatform = self.ui.platformComboBox.currentText()
+        remaining = set(platforms)
+        for i in reversed(range(1, self.ui.platformComboBox.count())):
+            if self.ui.platformComboBox.itemText(i) not in remaining:
+                self.ui.platformComboBox.removeItem(i)
+
+        # Both lists are sorted, so new platforms slot in where the shown ones stop matching
+        for i, platform in enumerate(platforms, 1):
+            if self.ui.platformComboBox.itemText(i) != platform:
+                self.ui.platformComboBox.insertItem(i, platform)
+
+        if selectedPlatform not in remaining and selectedPlatform != 'All Platforms':
+            self.ui.platformComboBox.setCurrentIndex(0)
+            self.displayTableWrapper()
+
     def displayTableWrapper(self):
         'Wraps displayTable() to pass information from the ui'
-        
+
+        # Anything still searching is out of date
+        self.stopSearch()
+
+        searchbox, platform = self.tableFilter()
+        self.displayTable(searchbox, platform)
+
+    def tableFilter(self):
+        'Returns the search text and platform to show, in the form GameLibrary.getGamesPage() takes'
+
         # Get text from the comboBox and search box
         platform = self.ui.platformComboBox.currentText()
         searchbox = self.ui.searchLineEdit.text()
 
-        # Set platform and searchbox to variables that work with GameLibrary.getGamesBySearch()
+        # Set platform and searchbox to variables that work with GameLibrary.getGamesPage()
         if platform == 'All Platforms':
             platform = ''
 
-        # Create header and body
-        headers = ['Platform', 'Title', 'Release Date', 'Genres']
-        games = self.gamelib.getGamesByQuery(searchbox, platform)
-        body = [(record[1], record[3], record[7], record[8]) for record in games]
-            
-        self.displayTable(headers, body)
+        return searchbox, platform
+
+    def queueSearch(self):
+        'Restarts the search timer so only a pause in typing runs a search'
+        self.searchTimer.start()
+
+    def startSearch(self):
+        'Runs the current search on the search thread, cancelling the one in progress'
+        self.stopSearch()
+
+        searchbox, platform = self.tableFilter()
+        self.searchFuture = self.searchPool.submit(self.runSearch, self.searchCount, self.gamelib, searchbox, platform)
+
+    def runSearch(self, number, gamelib, query, platform):
+        'Fetches the first page of a search, runs on the search thread'
+
+        # Skip searches that were replaced while they waited
+        if number != self.searchCount:
+            return
+
+        try:
+            page = gamelib.getGamesPage(limit=self.model.pagesize, query=query, platform=platform)
+        except sqlite3.Error:
+            # interrupted by a newer search, or the list was closed
+            return
+
+        self.searchFinished.emit(number, query, platform, page)
+
+    def showSearch(self, number, query, platform, page):
+        'Displays a finished search if nothing newer has been asked for'
+        if number == self.searchCount:
+            self.displayTable(query, platform, page)
+
+    def stopSearch(self):
+        'Makes any queued or running search out of date, interrupts its query and waits for it to stop'
+        self.searchTimer.stop()
+        self.searchCount += 1
+
+        # The search shares the GUI's connection, and an interrupt cancels whatever runs on it until
+        # the search's query has stopped, so nothing else may touch the list until then
+        if self.searchFuture is not None and not self.searchFuture.done():
+            self.gamelib.interrupt()
+            concurrent.futures.wait([self.searchFuture])
+
+    def displayTable(self, query, platform, page=None):
+        'Points the table model at the games matching query and platform, loading more as the view scrolls'
 
-    def displayTable(self, headers, body):
-        'Displays the table'
-        
         # Get currently selected row and column
-        oldrow = self.ui.tableWidget.currentRow()
-        oldcolumn = self.ui.tableWidget.currentColumn()
-
-        # Clear the table
-        self.ui.tableWidget.setColumnCount(0)
-        self.ui.tableWidget.setRowCount(0)
-        self.ui.tableWidget.clear()
-
-        # Display table headings
-        self.ui.tableWidget.setColumnCount(len(headers))
-        self.ui.tableWidget.setHorizontalHeaderLabels(headers)
-
-        # Populate the table
-        row, column = 0, 0
-        for record in body:
-
-            self.ui.tableWidget.insertRow(row)
-            
-            for item in record:
-                newcell = QTableWidgetItem(item)
-                self.ui.tableWidget.setItem(row, column, newcell)
-                column += 1
-
-            column = 0
-            row += 1
-
-        # Select the row/column that was selected before
-        if oldrow > self.ui.tableWidget.rowCount()-1:
-            oldrow -= 1
-        self.ui.tableWidget.setCurrentCell(oldrow, oldcolumn)
-        
+        current = self.table.currentIndex()
+        oldrow, oldcolumn = current.row(), current.column()
+
+        # Reload the first page
+        self.model.setQuery(query, platform, page)
+
+        # Select the row/column that was selected before, as long as it is loaded
+        if oldrow > self.model.rowCount()-1:
+            oldrow = self.model.rowCount()-1
+        if oldrow >= 0:
+            self.table.setCurrentIndex(self.model.index(oldrow, max(oldcolumn, 0)))
 
     def new(self):
         'Starts a new file'
         # See if current file is saved first
         self.savecheck()
 
-        # Close the file and make a new temp file
+        # Close the file and start an empty in-memory list
+        self.stopSearch()
         self.gamelib.close()
         self.filename = 'untitled.db'
-        self.gamelib = gamelist.gamelibrary.GameLibrary('untitled.db')
+        self.gamelib = gamelist.gamelibrary.GameLibrary(':memory:', threaded=True)
+        self.gamelib.addListener(self.libraryChanged)
+        self.model.setLibrary(self.gamelib)
         self.refreshUi()
         
     def open_(self):
@@ -228,10 +320,15 @@ class GameListGUI(QMainWindow):
         if file == '':
                 return
 
-        # Open the file and refreshe the ui
+        # Load the file into memory and refresh the ui
         self.filename = file
+        self.stopSearch()
         self.gamelib.close()
-        self.gamelib = gamelist.gamelibrary.GameLibrary(self.filename)
+        self.gamelib = gamelist.gamelibrary.GameLibrary(':memory:', threaded=True)
+        self.model.setLibrary(self.gamelib)
+        self.gamelib.load(self.filename, progress=self.copyProgress)
+        self.gamelib.addListener(self.libraryChanged)
+        self.statusbar.clearMessage()
         self.refreshUi()
 
     def save(self):
@@ -251,20 +348,19 @@ class GameListGUI(QMainWindow):
             if not self.filename.endswith('.db'):
                 self.filename += '.db'
 
-            # If file already exists, delete it
-            if os.path.isfile(self.filename):
-                os.remove(self.filename)
-
-            # Close the default file, move it to where user wants, reopen it
-            self.gamelib.save()
-            self.gamelib.close()
-            os.rename('untitled.db', self.filename)
-            self.gamelib = gamelist.gamelibrary.GameLibrary(self.filename)
-            self.refreshUi()
+            # Copy the in-memory list to where the user wants, replacing anything there
+            self.gamelib.save(self.filename, progress=self.copyProgress)
 
         else:
-            self.gamelib.save()
-            self.refreshUi()
+            self.gamelib.save(progress=self.copyProgress)
+
+        self.statusbar.clearMessage()
+        self.refreshUi()
+
+    def copyProgress(self, done, total):
+        'Shows load and save progress in the status bar'
+        self.statusbar.showMessage('Copying... {}%'.format(100 * done // max(total, 1)))
+        QApplication.processEvents()
 
     def savecheck(self):
         'Asks the user to save if there are unsaved changes'
@@ -285,21 +381,28 @@ class GameListGUI(QMainWindow):
         'Imports from .csv file'
         
         self.savecheck()
-        file = QFileDialog.getOpenFileName(self, 'Import file', '', 'CSV (Comma delimited) (*.csv)')
+        file, _ = QFileDialog.getOpenFileName(self, 'Import file', '', 'CSV (Comma delimited) (*.csv *.csv.gz)')
 
         if file != '':
-            self.gamelib.import_(file)
+            count = self.gamelib.import_(file, progress=self.importProgress)
+            self.statusbar.showMessage('Imported {} games.'.format(count))
 
         self.refreshUi()
 
+    def importProgress(self, count):
+        'Shows import progress in the status bar'
+        self.statusbar.showMessage('Importing... {} games.'.format(count))
+        QApplication.processEvents()
+
     def export(self):
         'Exports to .csv file'
         
         self.savecheck()
-        file = QFileDialog.getSaveFileName(self, 'Export file', '', 'CSV (Comma delimited) (*.csv)')
+        file, selected = QFileDialog.getSaveFileName(self, 'Export file', '',
+                                                     'CSV (Comma delimited) (*.csv);;Compressed CSV (*.csv.gz)')
 
         if file != '':
-            self.gamelib.export(file)
+            self.gamelib.export(file, compress=selected.startswith('Compressed') or file.endswith('.gz'))
 
         self.refreshUi()
 
@@ -320,9 +423,7 @@ class GameListGUI(QMainWindow):
             titleid = game['id']
             platformid = self.platforms.getPlatformId(platform)
 
-            genres = ''
-            for item in game['genres']:
-                genres += item['name'] + ' '
+            genres = [item['name'] for item in game['genres']]
 
             release_date = ''
             for item in game['release_dates']:
@@ -333,41 +434,50 @@ class GameListGUI(QMainWindow):
             coverUrl = game['cover']['url']
 
             # Finally, insert everything
-            self.gamelib.add(platform, title, titleid=titleid, platformid=platformid, cover=coverUrl, coverid=coverid,
-                             release_date=release_date, genres=genres)
-
-            self.refreshUi()
+            uid = self.gamelib.add(platform, title, titleid=titleid, platformid=platformid, cover=coverUrl, coverid=coverid,
+                                   release_date=release_date, genres=genres)
+            if uid is None:
+                self.statusbar.showMessage('{} is already in the list.'.format(title))
             self.ui.titleLineEdit.setText('')
             self.ui.titleLineEdit.setFocus()
 
+        except urllib.error.HTTPError as e:
+            if not gamelist.igdb.retryable(e):
+                self.addPlainRecord(platform, title)
+                return
+
+            # IGDB was still rate limited or failing after retrying, leave the title for the user to try again
+            self.statusbar.showMessage('IGDB is busy ({}), {} was not added.'.format(e, title))
+
         except:
             # If all else fails, just insert what the user entered.
-            self.gamelib.add(platform, title)
+            self.addPlainRecord(platform, title)
 
-            self.refreshUi()
-            self.ui.titleLineEdit.setText('')
-            self.ui.titleLineEdit.setFocus()
+    def addPlainRecord(self, platform, title):
+        'Adds a record with just the platform and title the user entered'
+        if self.gamelib.add(platform, title) is None:
+            self.statusbar.showMessage('{} is already in the list.'.format(title))
+        self.ui.titleLineEdit.setText('')
+        self.ui.titleLineEdit.setFocus()
 
     def removeRecord(self):
-        'Removes the highlighted row from the database'
-        row = self.ui.tableWidget.currentRow()
+        'Removes the highlighted rows from the database'
+        rows = set(index.row() for index in self.table.selectionModel().selectedRows())
 
-        if row == -1:
+        if not rows:
             return
 
-        platform = self.ui.tableWidget.item(row, 0).text()
-        title = self.ui.tableWidget.item(row, 1).text()
+        ids = [self.model.gameId(row) for row in rows]
 
-        self.gamelib.remove(platform, title)
-        self.refreshUi()
+        self.gamelib.remove_many(ids)
 
     def closeEvent(self, event):
         'Cleanup when the window closes'
         
         self.savecheck()
+        self.stopSearch()
+        self.searchPool.shutdown()
         self.gamelib.close()
+        self.igdb.close()
 
-        if os.path.isfile('untitled.db'):
-            os.remove('untitled.db')
-        
         event.accept()